@@ -1,8 +1,21 @@
+import threading
 import numpy as np
-from sentence_transformers import SentenceTransformer
 from typing import Dict, Any, List, Tuple, Optional
 
-model = SentenceTransformer("sentence-transformers/paraphrase-multilingual-mpnet-base-v2")
+MODEL_NAME = "sentence-transformers/paraphrase-multilingual-mpnet-base-v2"
+
+# Loaded on first use (or by the server's warm-up) instead of at import time
+_model = None
+_model_lock = threading.Lock()
+
+
+def get_model():
+    global _model
+    with _model_lock:
+        if _model is None:
+            from sentence_transformers import SentenceTransformer
+            _model = SentenceTransformer(MODEL_NAME)
+        return _model
 
 
 def tokenize(text: str) -> List[str]:
@@ -10,7 +23,7 @@ def tokenize(text: str) -> List[str]:
 
 
 def get_token_embeddings(tokens: List[str]) -> List[np.ndarray]:
-    return model.encode(tokens, convert_to_tensor=False)
+    return get_model().encode(tokens, convert_to_tensor=False)
 
 
 def semantic_distance(embed_a: np.ndarray, embed_b: np.ndarray) -> float:
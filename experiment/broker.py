@@ -0,0 +1,514 @@
+import os
+import json
+import time
+import socket
+import sqlite3
+import uuid
+from abc import ABC, abstractmethod
+from contextlib import closing, contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Any, Tuple
+
+# Default broker lives next to the job files so every process on this host sharing TEMP_DIR sees it
+DEFAULT_BROKER_URL = "sqlite:///temp/broker.sqlite3"
+
+# Seconds after which a session whose owner stopped heartbeating is considered gone
+SESSION_TTL = 30.0
+
+# Seconds a disconnected client has to reconnect before its jobs are cancelled
+DISCONNECT_GRACE = 60.0
+
+# Seconds a running job's worker may go without renewing its lease before the job is taken back
+JOB_LEASE_TTL = 120.0
+
+# Times a job is handed to a worker before a lost lease marks it failed instead of requeueing it
+MAX_JOB_ATTEMPTS = 2
+
+# Seconds after which undelivered messages are dropped
+MESSAGE_TTL = 300.0
+
+# Seconds finished (done, failed or cancelled) jobs are kept before they are dropped
+JOB_TTL = 3600.0
+
+# Seconds after which a session nobody heartbeats any more (its owner process died) is dropped
+SESSION_RETENTION = 3600.0
+
+
+def make_owner_id() -> str:
+    """Unique id for this process, used to route messages back to its websockets"""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class Broker(ABC):
+    """
+    Shared registry of websocket sessions, job queue and outgoing messages.
+
+    Any API process can accept an upload for a client connected to another process:
+    the job is queued here, picked up by whichever worker claims it, and progress
+    messages are published here until the process owning the client's socket
+    fetches and delivers them.
+    """
+
+    @abstractmethod
+    def register_session(self, client_id: str, owner: str) -> None:
+        ...
+
+    @abstractmethod
+    def unregister_session(self, client_id: str, owner: str) -> None:
+        ...
+
+    @abstractmethod
+    def touch_sessions(self, owner: str) -> None:
+        ...
+
+    @abstractmethod
+    def session_owner(self, client_id: str) -> Optional[str]:
+        ...
+
+    @abstractmethod
+    def submit_job(self, job_id: str, job_key: str, client_id: str, payload: Dict[str, Any]) -> Tuple[str, bool]:
+        """
+        Queue a job, or subscribe the client to an identical one already in flight.
+
+        Returns the id of the job serving the client and whether it was coalesced
+        into an existing job.
+        """
+        ...
+
+    @abstractmethod
+    def claim_job(self, worker: str) -> Optional[Dict[str, Any]]:
+        ...
+
+    @abstractmethod
+    def renew_job(self, job_id: str, worker: str) -> bool:
+        """Extend the worker's lease on a running job; False if the worker no longer holds it"""
+        ...
+
+    @abstractmethod
+    def finish_job(self, job_id: str, worker: str, status: str) -> None:
+        ...
+
+    @abstractmethod
+    def complete_job(self, job_id: str, worker: str, body: str) -> bool:
+        """
+        Mark a job the worker still holds done and publish its JSON result to its subscribers atomically.
+
+        A client either subscribes before this and receives the result, or afterwards
+        and starts a new job; it can never join after the result was fanned out.
+        Returns False (publishing nothing) if the job was no longer running on this worker.
+        """
+        ...
+
+    @abstractmethod
+    def job_state(self, job_id: str) -> Tuple[Optional[str], Optional[str]]:
+        """Status of the job and the worker holding it; (None, None) for an unknown job"""
+        ...
+
+    @abstractmethod
+    def unsubscribe(self, job_id: str, client_id: str) -> Optional[str]:
+        """
+        Stop sending a job's updates to a client, cancelling the job if nobody else waits for it.
+
+        Returns "stopped" if the job was cancelled, "detached" if other clients still wait
+        for it, "finished" if it is no longer queued or running (nothing changes then),
+        or None if the client was not subscribed to it.
+        """
+        ...
+
+    @abstractmethod
+    def cancel_abandoned_jobs(self, grace: float = DISCONNECT_GRACE) -> List[str]:
+        """Cancel in-flight jobs none of whose subscribers has been connected within grace seconds"""
+        ...
+
+    @abstractmethod
+    def purge_unclaimed_cancelled_jobs(self) -> List[Dict[str, Any]]:
+        """
+        Remove jobs cancelled before any worker claimed them and return their payloads.
+
+        No pipeline ever ran for them, so the caller has to release their files.
+        """
+        ...
+
+    @abstractmethod
+    def recover_stale_jobs(self, lease: float = JOB_LEASE_TTL) -> List[str]:
+        """
+        Take back running jobs whose worker stopped renewing its lease.
+
+        They are requeued, or marked failed once they used up MAX_JOB_ATTEMPTS.
+        Returns the ids of the recovered jobs.
+        """
+        ...
+
+    @abstractmethod
+    def publish(self, client_id: str, kind: str, body: str) -> None:
+        ...
+
+    @abstractmethod
+    def publish_job(self, job_id: str, kind: str, body: str) -> None:
+        """Publish a message to every client subscribed to a job"""
+        ...
+
+    @abstractmethod
+    def fetch_messages(self, owner: str) -> List[Dict[str, Any]]:
+        ...
+
+    @abstractmethod
+    def purge_expired_messages(self) -> int:
+        """Drop messages older than MESSAGE_TTL, left for clients that never came back"""
+        ...
+
+    @abstractmethod
+    def purge_expired_jobs(self, ttl: float = JOB_TTL) -> int:
+        """Drop jobs finished more than ttl seconds ago, with their subscriptions"""
+        ...
+
+    @abstractmethod
+    def purge_expired_sessions(self, ttl: float = SESSION_RETENTION) -> int:
+        """Drop sessions not heartbeated for ttl seconds, left by owner processes that died"""
+        ...
+
+
+class SQLiteBroker(Broker):
+    """
+    Broker backed by a single SQLite file.
+
+    Needs no external service, but is single-host only: every API and worker process
+    must run on the machine holding the file. The file uses WAL journaling, which
+    relies on shared memory and does not work over a network filesystem, so do not
+    point processes on several machines at one file; spreading across machines needs
+    another Broker backend.
+
+    Job payloads carry the absolute input_path, so every process must also see
+    TEMP_DIR at the same absolute path (mind this when workers run in containers).
+    A fresh connection is opened per call so the broker is safe to use from any thread.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS sessions (
+                    client_id TEXT PRIMARY KEY,
+                    owner TEXT NOT NULL,
+                    last_seen REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id TEXT PRIMARY KEY,
+                    job_key TEXT NOT NULL,
+                    client_id TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    worker TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    created REAL NOT NULL,
+                    updated REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created);
+                CREATE INDEX IF NOT EXISTS jobs_key ON jobs (job_key, status);
+                CREATE TABLE IF NOT EXISTS job_subscribers (
+                    job_id TEXT NOT NULL,
+                    client_id TEXT NOT NULL,
+                    PRIMARY KEY (job_id, client_id)
+                );
+                CREATE TABLE IF NOT EXISTS messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    client_id TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    body TEXT NOT NULL,
+                    created REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS messages_client ON messages (client_id, id);
+                CREATE INDEX IF NOT EXISTS messages_created ON messages (created);
+            """)
+            # Broker files created before job leases existed lack the attempts column
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(jobs)")]
+            if "attempts" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+
+    def _connect(self) -> sqlite3.Connection:
+        # isolation_level=None lets us issue BEGIN IMMEDIATE ourselves where atomicity matters
+        return sqlite3.connect(self.path, timeout=10, isolation_level=None)
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        """Connection holding the write lock for the block, committed on success and rolled back on error"""
+        with closing(self._connect()) as conn:
+            # If BEGIN itself fails (database is locked) no transaction is open and its error propagates
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def register_session(self, client_id: str, owner: str) -> None:
+        with closing(self._connect()) as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (client_id, owner, last_seen) VALUES (?, ?, ?)",
+                (client_id, owner, time.time())
+            )
+
+    def unregister_session(self, client_id: str, owner: str) -> None:
+        # Only release the session if the client has not reconnected to another process meanwhile.
+        # The row is kept with its disconnect time so the client's jobs get a grace period.
+        with closing(self._connect()) as conn:
+            conn.execute(
+                "UPDATE sessions SET owner = '', last_seen = ? WHERE client_id = ? AND owner = ?",
+                (time.time(), client_id, owner)
+            )
+
+    def touch_sessions(self, owner: str) -> None:
+        with closing(self._connect()) as conn:
+            conn.execute(
+                "UPDATE sessions SET last_seen = ? WHERE owner = ?",
+                (time.time(), owner)
+            )
+
+    def session_owner(self, client_id: str) -> Optional[str]:
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT owner FROM sessions WHERE client_id = ? AND owner != '' AND last_seen > ?",
+                (client_id, time.time() - SESSION_TTL)
+            ).fetchone()
+        return row[0] if row else None
+
+    def submit_job(self, job_id: str, job_key: str, client_id: str, payload: Dict[str, Any]) -> Tuple[str, bool]:
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute(
+                # Only join jobs that will finish: queued ones, or running ones whose worker holds a live lease
+                "SELECT job_id FROM jobs WHERE job_key = ? "
+                "AND (status = 'queued' OR (status = 'running' AND updated > ?)) "
+                "ORDER BY created LIMIT 1",
+                (job_key, now - JOB_LEASE_TTL)
+            ).fetchone()
+            coalesced = row is not None
+            if coalesced:
+                job_id = row[0]
+            else:
+                conn.execute(
+                    "INSERT INTO jobs (job_id, job_key, client_id, payload, status, created, updated) "
+                    "VALUES (?, ?, ?, ?, 'queued', ?, ?)",
+                    (job_id, job_key, client_id, json.dumps(payload), now, now)
+                )
+            conn.execute(
+                "INSERT OR IGNORE INTO job_subscribers (job_id, client_id) VALUES (?, ?)",
+                (job_id, client_id)
+            )
+        return job_id, coalesced
+
+    def claim_job(self, worker: str) -> Optional[Dict[str, Any]]:
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT job_id, client_id, payload FROM jobs "
+                "WHERE status = 'queued' ORDER BY created LIMIT 1"
+            ).fetchone()
+            if not row:
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = 'running', worker = ?, attempts = attempts + 1, updated = ? "
+                "WHERE job_id = ?",
+                (worker, time.time(), row[0])
+            )
+        return {"job_id": row[0], "client_id": row[1], "payload": json.loads(row[2])}
+
+    def renew_job(self, job_id: str, worker: str) -> bool:
+        # jobs.updated doubles as the lease heartbeat while a job is running
+        with closing(self._connect()) as conn:
+            renewed = conn.execute(
+                "UPDATE jobs SET updated = ? WHERE job_id = ? AND worker = ? AND status = 'running'",
+                (time.time(), job_id, worker)
+            ).rowcount
+        return bool(renewed)
+
+    def finish_job(self, job_id: str, worker: str, status: str) -> None:
+        with closing(self._connect()) as conn:
+            # A cancelled job stays cancelled even if the worker ran it to completion, and a
+            # worker whose lease was taken back no longer owns the job
+            conn.execute(
+                "UPDATE jobs SET status = ?, updated = ? "
+                "WHERE job_id = ? AND worker = ? AND status = 'running'",
+                (status, time.time(), job_id, worker)
+            )
+
+    def complete_job(self, job_id: str, worker: str, body: str) -> bool:
+        now = time.time()
+        with self._transaction() as conn:
+            completed = conn.execute(
+                "UPDATE jobs SET status = 'done', updated = ? "
+                "WHERE job_id = ? AND worker = ? AND status = 'running'",
+                (now, job_id, worker)
+            ).rowcount
+            if completed:
+                conn.execute(
+                    "INSERT INTO messages (client_id, kind, body, created) "
+                    "SELECT client_id, 'json', ?, ? FROM job_subscribers WHERE job_id = ?",
+                    (body, now, job_id)
+                )
+        return bool(completed)
+
+    def job_state(self, job_id: str) -> Tuple[Optional[str], Optional[str]]:
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT status, worker FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return (row[0], row[1]) if row else (None, None)
+
+    def unsubscribe(self, job_id: str, client_id: str) -> Optional[str]:
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT j.status FROM job_subscribers js JOIN jobs j ON j.job_id = js.job_id "
+                "WHERE js.job_id = ? AND js.client_id = ?",
+                (job_id, client_id)
+            ).fetchone()
+            if row is None:
+                return None
+            # Subscriptions to finished jobs are kept until the job expires; detaching from
+            # one would stop nothing, as its result was already sent
+            if row[0] not in ("queued", "running"):
+                return "finished"
+            conn.execute(
+                "DELETE FROM job_subscribers WHERE job_id = ? AND client_id = ?",
+                (job_id, client_id)
+            )
+            cancelled = conn.execute(
+                "UPDATE jobs SET status = 'cancelled', updated = ? "
+                "WHERE job_id = ? AND NOT EXISTS (SELECT 1 FROM job_subscribers WHERE job_id = jobs.job_id)",
+                (time.time(), job_id)
+            ).rowcount
+        return "stopped" if cancelled else "detached"
+
+    def cancel_abandoned_jobs(self, grace: float = DISCONNECT_GRACE) -> List[str]:
+        now = time.time()
+        with self._transaction() as conn:
+            # Connected sessions are heartbeated well within the grace period, so only
+            # clients that disconnected (or whose process died) longer ago fall out
+            job_ids = [row[0] for row in conn.execute(
+                "SELECT job_id FROM jobs WHERE status IN ('queued', 'running') AND NOT EXISTS ("
+                "SELECT 1 FROM job_subscribers js JOIN sessions s ON s.client_id = js.client_id "
+                "WHERE js.job_id = jobs.job_id AND s.last_seen > ?)",
+                (now - grace,)
+            )]
+            conn.executemany(
+                "UPDATE jobs SET status = 'cancelled', updated = ? WHERE job_id = ?",
+                [(now, job_id) for job_id in job_ids]
+            )
+            conn.execute(
+                "DELETE FROM sessions WHERE owner = '' AND last_seen <= ?",
+                (now - grace,)
+            )
+        return job_ids
+
+    def purge_unclaimed_cancelled_jobs(self) -> List[Dict[str, Any]]:
+        with self._transaction() as conn:
+            rows = conn.execute(
+                "SELECT job_id, payload FROM jobs WHERE status = 'cancelled' AND worker IS NULL"
+            ).fetchall()
+            conn.executemany("DELETE FROM job_subscribers WHERE job_id = ?", [(row[0],) for row in rows])
+            conn.executemany("DELETE FROM jobs WHERE job_id = ?", [(row[0],) for row in rows])
+        return [json.loads(row[1]) for row in rows]
+
+    def recover_stale_jobs(self, lease: float = JOB_LEASE_TTL) -> List[str]:
+        now = time.time()
+        with self._transaction() as conn:
+            rows = conn.execute(
+                "SELECT job_id, attempts FROM jobs WHERE status = 'running' AND updated < ?",
+                (now - lease,)
+            ).fetchall()
+            for job_id, attempts in rows:
+                if attempts < MAX_JOB_ATTEMPTS:
+                    conn.execute(
+                        "UPDATE jobs SET status = 'queued', worker = NULL, updated = ? WHERE job_id = ?",
+                        (now, job_id)
+                    )
+                    message = "Processing was interrupted. Retrying..."
+                else:
+                    conn.execute(
+                        "UPDATE jobs SET status = 'failed', updated = ? WHERE job_id = ?",
+                        (now, job_id)
+                    )
+                    message = "Error during processing: the worker stopped responding"
+                conn.execute(
+                    "INSERT INTO messages (client_id, kind, body, created) "
+                    "SELECT client_id, 'text', ?, ? FROM job_subscribers WHERE job_id = ?",
+                    (message, now, job_id)
+                )
+        return [row[0] for row in rows]
+
+    def publish(self, client_id: str, kind: str, body: str) -> None:
+        with closing(self._connect()) as conn:
+            conn.execute(
+                "INSERT INTO messages (client_id, kind, body, created) VALUES (?, ?, ?, ?)",
+                (client_id, kind, body, time.time())
+            )
+
+    def publish_job(self, job_id: str, kind: str, body: str) -> None:
+        with closing(self._connect()) as conn:
+            conn.execute(
+                "INSERT INTO messages (client_id, kind, body, created) "
+                "SELECT client_id, ?, ?, ? FROM job_subscribers WHERE job_id = ?",
+                (kind, body, time.time(), job_id)
+            )
+
+    def fetch_messages(self, owner: str) -> List[Dict[str, Any]]:
+        """Pop every pending message addressed to a client whose socket this owner holds"""
+        # Polled several times a second by every API process, so only take the write lock
+        # when there is something to delete
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT m.id, m.client_id, m.kind, m.body FROM messages m "
+                "JOIN sessions s ON s.client_id = m.client_id "
+                "WHERE s.owner = ? ORDER BY m.id",
+                (owner,)
+            ).fetchall()
+        if rows:
+            # Delete exactly the rows read: sessions may have changed owner since the SELECT,
+            # and messages of a client that just reconnected here were not read yet
+            with self._transaction() as conn:
+                conn.executemany("DELETE FROM messages WHERE id = ?", [(r[0],) for r in rows])
+        return [{"client_id": r[1], "kind": r[2], "body": r[3]} for r in rows]
+
+    def purge_expired_messages(self) -> int:
+        with closing(self._connect()) as conn:
+            return conn.execute(
+                "DELETE FROM messages WHERE created < ?",
+                (time.time() - MESSAGE_TTL,)
+            ).rowcount
+
+    def purge_expired_jobs(self, ttl: float = JOB_TTL) -> int:
+        with self._transaction() as conn:
+            # Jobs cancelled before any worker claimed them are left to purge_unclaimed_cancelled_jobs,
+            # which hands their files back for cleanup
+            expired = (
+                "SELECT job_id FROM jobs WHERE status NOT IN ('queued', 'running') AND updated < ? "
+                "AND NOT (status = 'cancelled' AND worker IS NULL)"
+            )
+            cutoff = time.time() - ttl
+            conn.execute(f"DELETE FROM job_subscribers WHERE job_id IN ({expired})", (cutoff,))
+            return conn.execute(f"DELETE FROM jobs WHERE job_id IN ({expired})", (cutoff,)).rowcount
+
+    def purge_expired_sessions(self, ttl: float = SESSION_RETENTION) -> int:
+        with closing(self._connect()) as conn:
+            return conn.execute(
+                "DELETE FROM sessions WHERE last_seen < ?",
+                (time.time() - ttl,)
+            ).rowcount
+
+
+def create_broker(url: str) -> Broker:
+    """Create a broker from a URL such as sqlite:///temp/broker.sqlite3"""
+    if url.startswith("sqlite:///"):
+        return SQLiteBroker(url[len("sqlite:///"):])
+    raise ValueError(f"Unsupported broker URL: {url}")
+
+
+_broker: Optional[Broker] = None
+
+
+def get_broker() -> Broker:
+    """Process-wide broker configured through the BROKER_URL environment variable"""
+    global _broker
+    if _broker is None:
+        _broker = create_broker(os.getenv("BROKER_URL", DEFAULT_BROKER_URL))
+    return _broker
@@ -4,8 +4,7 @@ from pathlib import Path
 import asyncio
 import shutil
 import uuid
-import demucs.separate
-import torch
+import hashlib
 from fastapi import FastAPI, File, UploadFile, WebSocket, WebSocketDisconnect, Query
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.responses import JSONResponse
@@ -21,10 +20,12 @@ class WERRequest(BaseModel):
     hypothesis: str
 
 # Import local modules
-from vad_filter import filter_vad
-from simple_transcribe import transcribe
-from lyrics_transliterator import add_transliteration as add_trans, validate_azure_openai_key
 from ai_wer import calculate_wer
+from broker import get_broker, make_owner_id
+from pipeline import send_update
+from progress import progress_bus
+from worker import run_worker
+from warmup import start_warm_up, capability_status, readiness
 
 app = FastAPI(title="Audio Transcription API")
 
@@ -37,7 +38,8 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Create a directory for temporary files
+# Create a directory for temporary files; job payloads store absolute paths into it, so
+# separate worker processes must see it at the same absolute path
 TEMP_DIR = Path("./temp")
 TEMP_DIR.mkdir(exist_ok=True)
 
@@ -45,23 +47,96 @@ TEMP_DIR.mkdir(exist_ok=True)
 RESOURCES_DIR = Path("./resources")
 RESOURCES_DIR.mkdir(exist_ok=True)
 
-# Store active websocket connections
+# Store websocket connections held by this process
 active_connections: Dict[str, WebSocket] = {}
 
-# Check if Azure OpenAI API is available
-AZURE_API_AVAILABLE = validate_azure_openai_key()
-if not AZURE_API_AVAILABLE:
-    print("Warning: Azure OpenAI API is not available. Transliteration feature will be disabled.")
+# Sessions and jobs are shared with other API and worker processes through the broker
+broker = get_broker()
+OWNER_ID = make_owner_id()
 
-async def send_update(client_id: str, message: str):
-    """Send status update to client via websocket"""
-    if client_id in active_connections:
-        await active_connections[client_id].send_text(message)
+# Number of uvicorn worker processes serving the API
+API_WORKERS = int(os.getenv("API_WORKERS", "1"))
+
+# Number of in-process worker threads; set to 0 when running worker.py separately. Each API process
+# with workers holds its own whisper model and the decode lock only spans one process, so with
+# several API processes jobs are left to worker.py to keep concurrent decodes off the GPU
+WORKER_THREADS = int(os.getenv("WORKER_THREADS", "0" if API_WORKERS > 1 else "1"))
+
+# Seconds between polls for messages addressed to this process's clients
+DELIVERY_INTERVAL = 0.2
+
+# Seconds between session heartbeats
+HEARTBEAT_INTERVAL = 10.0
+
+def azure_api_available() -> bool:
+    """Whether the Azure OpenAI probe run during warm-up succeeded"""
+    return capability_status("transliteration") == "ready"
+
+async def deliver_messages():
+    """Forward messages published by any worker to the websockets this process holds"""
+    last_heartbeat = 0.0
+    loop = asyncio.get_running_loop()
+    # In-process workers wake us through the progress bus; other processes are picked up by polling
+    wakeup = asyncio.Event()
+    progress_bus.bind(loop, wakeup)
+    while True:
+        try:
+            if loop.time() - last_heartbeat > HEARTBEAT_INTERVAL:
+                await asyncio.to_thread(broker.touch_sessions, OWNER_ID)
+                # Give compute back to jobs someone is still waiting for
+                for job_id in await asyncio.to_thread(broker.cancel_abandoned_jobs):
+                    print(f"Cancelled job {job_id}: all clients disconnected")
+                # Jobs cancelled while still queued never reach the pipeline, which cleans up the others
+                for payload in await asyncio.to_thread(broker.purge_unclaimed_cancelled_jobs):
+                    await asyncio.to_thread(shutil.rmtree, Path(payload["input_path"]).parent, True)
+                await asyncio.to_thread(broker.purge_expired_messages)
+                await asyncio.to_thread(broker.purge_expired_jobs)
+                await asyncio.to_thread(broker.purge_expired_sessions)
+                # Take back jobs whose worker died so their clients are not left waiting
+                for job_id in await asyncio.to_thread(broker.recover_stale_jobs):
+                    print(f"Recovered job {job_id}: worker lease expired")
+                last_heartbeat = loop.time()
+            # fetch_messages already removed these from the broker, so anything that cannot be sent
+            # (socket gone or closing) is published again for when the client reconnects
+            undeliverable = []
+            failed_clients = set()
+            for message in await asyncio.to_thread(broker.fetch_messages, OWNER_ID):
+                client_id = message["client_id"]
+                websocket = active_connections.get(client_id)
+                # Once a send failed, later messages of that client are held back too to keep their order
+                if websocket is None or client_id in failed_clients:
+                    undeliverable.append(message)
+                    continue
+                try:
+                    # JSON payloads are stored serialized, so both kinds go out as text frames
+                    await websocket.send_text(message["body"])
+                except Exception as e:
+                    print(f"Failed to deliver message to {client_id}: {e}")
+                    failed_clients.add(client_id)
+                    undeliverable.append(message)
+            for message in undeliverable:
+                await asyncio.to_thread(broker.publish, message["client_id"], message["kind"], message["body"])
+        except Exception as e:
+            print(f"Message delivery error: {e}")
+        try:
+            await asyncio.wait_for(wakeup.wait(), DELIVERY_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        wakeup.clear()
+
+@app.on_event("startup")
+async def startup():
+    # Models and the Azure probe load in the background so the server accepts connections right away
+    start_warm_up(["transcription", "transliteration", "wer"] if WORKER_THREADS > 0 else ["transliteration", "wer"])
+    app.state.delivery_task = asyncio.create_task(deliver_messages())
+    for _ in range(WORKER_THREADS):
+        threading.Thread(target=run_worker, daemon=True).start()
 
 @app.websocket("/ws/{client_id}")
 async def websocket_endpoint(websocket: WebSocket, client_id: str):
     await websocket.accept()
     active_connections[client_id] = websocket
+    await asyncio.to_thread(broker.register_session, client_id, OWNER_ID)
     try:
         await websocket.send_text(f"Connected with client_id: {client_id}")
         # Keep connection open until client disconnects
@@ -70,13 +145,40 @@ async def websocket_endpoint(websocket: WebSocket, client_id: str):
             if data == "ping":
                 await websocket.send_text("pong")
     except WebSocketDisconnect:
-        if client_id in active_connections:
-            del active_connections[client_id]
+        if active_connections.get(client_id) is websocket:
+            # Release the session first so delivery stops routing this client's messages here
+            # before the socket disappears; messages already fetched are published back
+            await asyncio.to_thread(broker.unregister_session, client_id, OWNER_ID)
+            if active_connections.get(client_id) is websocket:
+                del active_connections[client_id]
+
+@app.get("/healthz")
+async def healthz():
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    state = readiness()
+    return JSONResponse(status_code=200 if state["ready"] else 503, content=state)
 
 @app.post("/calculate-wer")
 async def calculate_wer_endpoint(payload: WERRequest):
+    # Loading the model here would block the event loop, so only serve once the warm-up loaded it;
+    # a failed load is retried in the background once its backoff has passed
+    start_warm_up(["wer"])
+    status = capability_status("wer")
+    if status == "pending":
+        return JSONResponse(
+            status_code=503,
+            content={"error": "WER model is still loading. Try again shortly.", "success": False}
+        )
+    if status != "ready":
+        return JSONResponse(
+            status_code=503,
+            content={"error": "WER model is not available.", "success": False}
+        )
     try:
-        wer_result = calculate_wer(payload.reference, payload.hypothesis)
+        wer_result = await asyncio.to_thread(calculate_wer, payload.reference, payload.hypothesis)
         return wer_result
     except Exception as e:
         return {
@@ -93,14 +195,18 @@ async def upload_audio(
     beam_size: int = 20,
     enable_transliteration: bool = True
 ):
-    if not client_id or client_id not in active_connections:
+    # The client's websocket may be held by any API process sharing the broker
+    if not client_id or await asyncio.to_thread(broker.session_owner, client_id) is None:
         return JSONResponse(
             status_code=400,
             content={"error": "No active WebSocket connection. Connect to websocket first."}
         )
     
-    # Check if transliteration is available
-    if enable_transliteration and not AZURE_API_AVAILABLE:
+    # Check if transliteration is available; while the probe is pending the pipeline checks again before Step 3.
+    # A failed probe is retried here once its backoff has passed, so the outage does not outlive the blip
+    start_warm_up(["transliteration"])
+    transliteration_enabled = enable_transliteration and capability_status("transliteration") != "failed"
+    if enable_transliteration and not transliteration_enabled:
         await send_update(client_id, "Warning: Azure OpenAI API is not available. Transliteration will be disabled.")
     
     # Create a unique job ID
@@ -110,118 +216,82 @@ async def upload_audio(
     job_dir = TEMP_DIR / job_id
     job_dir.mkdir(exist_ok=True)
     
-    # Save the uploaded file
+    # Save the uploaded file, hashing it on the way so identical uploads can share one job
     input_path = job_dir / f"input.mp3"
+    audio_hash = hashlib.sha256()
     with open(input_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+        while chunk := file.file.read(1024 * 1024):
+            audio_hash.update(chunk)
+            buffer.write(chunk)
+    
+    job_key = ":".join([audio_hash.hexdigest(), language, model, str(beam_size), str(transliteration_enabled)])
     
-    # Start processing in a separate thread
-    process_thread = threading.Thread(
-        target=asyncio.run,
-        args=(process_audio(
-            str(input_path), 
-            client_id, 
-            job_id, 
-            language, 
-            model, 
-            beam_size,
-            enable_transliteration and AZURE_API_AVAILABLE
-        ),)
-    )
-    process_thread.start()
+    # Queue the job for whichever worker picks it up first, unless the same song is already in flight
+    job_id, coalesced = await asyncio.to_thread(broker.submit_job, job_id, job_key, client_id, {
+        "input_path": str(input_path.resolve()),
+        "job_id": job_id,
+        "language": language,
+        "model_name": model,
+        "beam_size": beam_size,
+        "enable_transliteration": transliteration_enabled
+    })
+    
+    if coalesced:
+        shutil.rmtree(job_dir, ignore_errors=True)
+        await send_update(client_id, "Identical audio is already being processed. Joining the running job...")
     
     return {
         "message": "Processing started", 
         "job_id": job_id, 
+        "coalesced": coalesced,
         "language": language, 
         "model": model,
         "options": {
-            "enable_transliteration": enable_transliteration and AZURE_API_AVAILABLE
+            "enable_transliteration": transliteration_enabled
         },
-        "azure_api_available": AZURE_API_AVAILABLE
+        "azure_api_available": azure_api_available()
     }
 
-async def process_audio(
-    input_path: str, 
-    client_id: str, 
-    job_id: str, 
-    language: str = "te", 
-    model_name: str = "large-v3", 
-    beam_size: int = 20,
-    enable_transliteration: bool = True
-):
-    job_dir = TEMP_DIR / job_id
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str, client_id: str):
+    # Other clients may have been coalesced into the same job, so only this client is detached;
+    # the job itself stops once nobody is waiting for it
+    outcome = await asyncio.to_thread(broker.unsubscribe, job_id, client_id)
+    if outcome is None:
+        return JSONResponse(
+            status_code=404,
+            content={"error": "No such job for this client."}
+        )
+    if outcome == "finished":
+        return JSONResponse(
+            status_code=409,
+            content={"error": "Job has already finished."}
+        )
     
-    try:
-        # Step 1: Remove music using demucs
-        await send_update(client_id, f"Step 1/3: Removing background music with Demucs...")
-        
-        demucs_output = job_dir / "demucs_output"
-        demucs_output.mkdir(exist_ok=True)
-        
-        demucs.separate.main([
-            "--two-stems=vocals", 
-            "-o", str(demucs_output),
-            input_path
-        ])
-        
-        vocals_path = next(demucs_output.glob("**/*vocals.wav"), None)
-        
-        if not vocals_path:
-            await send_update(client_id, "Error: Failed to extract vocals from audio")
-            return
-        
-        await send_update(client_id, "Music removal complete")
-        
-        # Step 2: Transcribe the audio
-        await send_update(client_id, f"Step 2/3: Transcribing {language} audio using {model_name} model with beam size {beam_size}...")
-        transcription_result = transcribe(str(vocals_path), model_name=model_name, language=language, beam_size=beam_size)
-        await send_update(client_id, "Transcription complete")
-
-        # Step 3: Transliteration with retry mechanism
-        transliterated_segments = None
-        if enable_transliteration:
-            await send_update(client_id, "Step 3/3: Adding transliteration...")
-            max_retries = 3
-            for attempt in range(1, max_retries + 1):
-                try:
-                    transliteration_result = add_trans(transcription_result, language)
-                    if "transliterated_segments" in transliteration_result:
-                        transliterated_segments = transliteration_result["transliterated_segments"]
-                    await send_update(client_id, "Transliteration complete")
-                    break  # Success
-                except Exception as te:
-                    await send_update(client_id, f"Transliteration attempt {attempt} failed: {str(te)}")
-                    if attempt == max_retries:
-                        await send_update(client_id, "Transliteration failed after multiple attempts. Proceeding without it.")
-                        transliterated_segments = None
-
-        final_result = {
-            "status": "complete",
-            "segments": transcription_result["segments"]
-        }
-
-        if transliterated_segments:
-            final_result["transliterated_segments"] = transliterated_segments
-        
-        await active_connections[client_id].send_json(final_result)
-        await send_update(client_id, "Processing complete!")
-
-    except Exception as e:
-        error_message = f"Error during processing: {str(e)}"
-        await send_update(client_id, error_message)
-    finally:
-        # Optional cleanup
-        # shutil.rmtree(job_dir, ignore_errors=True)
-        pass
+    # Only reached when the client was actually detached from a job still in flight
+    await send_update(client_id, "Job cancelled")
+    return {
+        "message": "Job cancelled",
+        "job_id": job_id,
+        "stopped": outcome == "stopped"
+    }
 
 @app.get("/")
 async def root():
     return {
         "message": "Audio Transcription API is running. Connect to WebSocket first, then upload your audio file.",
-        "azure_api_available": AZURE_API_AVAILABLE,
+        "azure_api_available": azure_api_available(),
         "supported_languages": ["hi", "te"]
     }
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # Several API processes can share the broker, so uvicorn workers are safe to use
+    if API_WORKERS > 1:
+        if WORKER_THREADS > 0:
+            raise SystemExit(
+                "WORKER_THREADS must be 0 when API_WORKERS > 1: every API process would load its own "
+                "whisper model and decode on the same GPU at once. Run worker.py for the jobs instead."
+            )
+        uvicorn.run("main:app", host="0.0.0.0", port=8000, workers=API_WORKERS)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
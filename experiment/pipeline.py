@@ -0,0 +1,163 @@
+import asyncio
+import json
+import shutil
+from pathlib import Path
+from typing import Dict, Any, Optional
+
+# Import local modules
+from simple_transcribe import transcribe
+from lyrics_transliterator import add_transliteration as add_trans
+from broker import get_broker
+from progress import progress_bus, JobProgress
+from warmup import ensure_capability
+
+class JobCancelled(Exception):
+    """Raised at a checkpoint once the job has been cancelled"""
+
+class JobLeaseLost(Exception):
+    """Raised at a checkpoint once the job was taken back from this worker and requeued"""
+
+class CancellationToken:
+    """Cooperative cancellation: the pipeline calls check() between stages and whisper windows"""
+
+    def __init__(self, job_id: str, worker_id: str):
+        self.job_id = job_id
+        self.worker_id = worker_id
+
+    def check(self):
+        status, worker = get_broker().job_state(self.job_id)
+        if status == "cancelled":
+            raise JobCancelled(self.job_id)
+        if status != "running" or worker != self.worker_id:
+            raise JobLeaseLost(self.job_id)
+
+async def send_update(client_id: str, message: str):
+    """Send status update to client; delivered by whichever process holds its websocket"""
+    # Broker writes can wait on the SQLite lock, so they run in a thread instead of on the caller's loop
+    await asyncio.to_thread(progress_bus.publish, client_id, "text", message)
+
+async def send_job_update(job_id: str, message: str):
+    """Send status update to every client subscribed to the job"""
+    await asyncio.to_thread(progress_bus.publish_job, job_id, "text", message)
+
+async def send_job_result(job_id: str, worker_id: str, result: Dict[str, Any]) -> bool:
+    """Send the final JSON payload to every client subscribed to the job, marking it done in the same step"""
+    return await asyncio.to_thread(progress_bus.complete_job, job_id, worker_id, json.dumps(result))
+
+async def process_audio(
+    input_path: str,
+    job_id: str,
+    worker_id: str,
+    language: str = "te",
+    model_name: str = "large-v3",
+    beam_size: int = 20,
+    enable_transliteration: bool = True
+) -> bool:
+    """Run the full pipeline for a job; returns whether it produced a result"""
+    job_dir = Path(input_path).parent
+    token = CancellationToken(job_id, worker_id)
+    progress = JobProgress(job_id)
+
+    def on_window(frames_done: int, total_frames: int, segments: Optional[int]):
+        # Runs between whisper windows: anything it raises aborts the decode, so a broker hiccup
+        # is only logged and just cancellation or a lost lease stops the job
+        try:
+            token.check()
+            progress.update(frames_done / total_frames if total_frames else 0.0, segments)
+        except (JobCancelled, JobLeaseLost):
+            raise
+        except Exception as e:
+            print(f"Progress check of job {job_id} failed: {e}")
+
+    try:
+        token.check()
+
+        # Step 1: Remove music using demucs
+        await send_job_update(job_id, f"Step 1/3: Removing background music with Demucs...")
+        progress.start_stage("separation")
+
+        # Imported here so API processes that never run jobs do not pay for it
+        import demucs.separate
+
+        demucs_output = job_dir / "demucs_output"
+        demucs_output.mkdir(exist_ok=True)
+
+        demucs.separate.main([
+            "--two-stems=vocals",
+            "-o", str(demucs_output),
+            input_path
+        ])
+
+        vocals_path = next(demucs_output.glob("**/*vocals.wav"), None)
+
+        if not vocals_path:
+            await send_job_update(job_id, "Error: Failed to extract vocals from audio")
+            return False
+
+        progress.finish_stage()
+        await send_job_update(job_id, "Music removal complete")
+        token.check()
+
+        # Step 2: Transcribe the audio
+        await send_job_update(job_id, f"Step 2/3: Transcribing {language} audio using {model_name} model with beam size {beam_size}...")
+        progress.start_stage("transcription")
+        transcription_result = transcribe(str(vocals_path), model_name=model_name, language=language, beam_size=beam_size, on_window=on_window, check_cancelled=token.check)
+        progress.finish_stage(len(transcription_result["segments"]))
+        await send_job_update(job_id, "Transcription complete")
+        token.check()
+
+        # Step 3: Transliteration with retry mechanism
+        transliterated_segments = None
+        # The job may have been queued before the Azure probe finished, or this may be a worker
+        # process that has not probed yet; either way, do not spend retries on an API that is down
+        if enable_transliteration and not await asyncio.to_thread(ensure_capability, "transliteration"):
+            await send_job_update(job_id, "Warning: Azure OpenAI API is not available. Skipping transliteration.")
+            enable_transliteration = False
+        if enable_transliteration:
+            await send_job_update(job_id, "Step 3/3: Adding transliteration...")
+            progress.start_stage("transliteration")
+            max_retries = 3
+            for attempt in range(1, max_retries + 1):
+                token.check()
+                try:
+                    transliteration_result = add_trans(transcription_result, language)
+                    if "transliterated_segments" in transliteration_result:
+                        transliterated_segments = transliteration_result["transliterated_segments"]
+                    progress.finish_stage()
+                    await send_job_update(job_id, "Transliteration complete")
+                    break  # Success
+                except Exception as te:
+                    await send_job_update(job_id, f"Transliteration attempt {attempt} failed: {str(te)}")
+                    if attempt == max_retries:
+                        await send_job_update(job_id, "Transliteration failed after multiple attempts. Proceeding without it.")
+                        transliterated_segments = None
+
+        final_result = {
+            "status": "complete",
+            "segments": transcription_result["segments"]
+        }
+
+        if transliterated_segments:
+            final_result["transliterated_segments"] = transliterated_segments
+
+        # False if the job was cancelled or taken back meanwhile; then nothing was sent
+        if not await send_job_result(job_id, worker_id, final_result):
+            return False
+        await send_job_update(job_id, "Processing complete!")
+        return True
+
+    except JobLeaseLost:
+        # Another worker owns the job now and uses the same job directory; leave both alone
+        print(f"Stopped job {job_id}: worker {worker_id} lost its lease")
+        return False
+    except JobCancelled:
+        await send_job_update(job_id, "Processing cancelled")
+        # Nobody is waiting for this job any more, so free its disk space right away
+        shutil.rmtree(job_dir, ignore_errors=True)
+        return False
+    except Exception as e:
+        error_message = f"Error during processing: {str(e)}"
+        await send_job_update(job_id, error_message)
+        return False
+    finally:
+        progress.close()
@@ -0,0 +1,115 @@
+import asyncio
+import json
+import threading
+import time
+from typing import Dict, Any, Optional
+
+from broker import get_broker
+
+# Minimum seconds between two coalesced progress events of the same job
+PROGRESS_INTERVAL = 1.0
+
+
+class ProgressBus:
+    """
+    Hands messages from worker threads to the server loop.
+
+    Messages always go through the broker so they reach clients connected to any
+    process. When the server loop of this process is bound, it is also woken up
+    right away (via call_soon_threadsafe) instead of on its next poll, so in-process
+    workers never touch websockets or the server loop directly.
+    """
+
+    def __init__(self, min_interval: float = PROGRESS_INTERVAL):
+        self.min_interval = min_interval
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._last_sent: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def bind(self, loop: asyncio.AbstractEventLoop, wakeup: asyncio.Event):
+        """Called by the server with its loop and the event its delivery task waits on"""
+        self._loop = loop
+        self._wakeup = wakeup
+
+    def _wake(self):
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def publish(self, client_id: str, kind: str, body: str):
+        get_broker().publish(client_id, kind, body)
+        self._wake()
+
+    def publish_job(self, job_id: str, kind: str, body: str):
+        get_broker().publish_job(job_id, kind, body)
+        self._wake()
+
+    def complete_job(self, job_id: str, worker: str, body: str) -> bool:
+        completed = get_broker().complete_job(job_id, worker, body)
+        self._wake()
+        return completed
+
+    def publish_event(self, job_id: str, event: Dict[str, Any], coalesce: bool = False):
+        """
+        Publish a structured event to the job's subscribers.
+
+        Coalesced events are dropped if another one for the same job went out less
+        than min_interval seconds ago; the next one carries the newer state anyway.
+        For the same reason a coalesced event the broker fails to store is only logged.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if coalesce and now - self._last_sent.get(job_id, 0.0) < self.min_interval:
+                return
+            self._last_sent[job_id] = now
+        try:
+            self.publish_job(job_id, "json", json.dumps(event))
+        except Exception as e:
+            if not coalesce:
+                raise
+            print(f"Failed to publish progress of job {job_id}: {e}")
+
+    def forget(self, job_id: str):
+        with self._lock:
+            self._last_sent.pop(job_id, None)
+
+
+progress_bus = ProgressBus()
+
+
+class JobProgress:
+    """Structured progress of one job: stage, percent of audio processed, ETA and partial segment count"""
+
+    def __init__(self, job_id: str, bus: ProgressBus = progress_bus):
+        self.job_id = job_id
+        self.bus = bus
+        self.stage = None
+        self.stage_started = 0.0
+
+    def start_stage(self, stage: str):
+        self.stage = stage
+        self.stage_started = time.monotonic()
+        self._publish(0.0, None, eta=None)
+
+    def update(self, fraction: float, segments: Optional[int] = None):
+        """Report progress within the current stage; high-frequency calls are coalesced"""
+        fraction = min(max(fraction, 0.0), 1.0)
+        elapsed = time.monotonic() - self.stage_started
+        eta = elapsed * (1.0 - fraction) / fraction if fraction > 0 else None
+        self._publish(fraction, segments, eta, coalesce=fraction < 1.0)
+
+    def finish_stage(self, segments: Optional[int] = None):
+        self._publish(1.0, segments, eta=0.0)
+
+    def close(self):
+        self.bus.forget(self.job_id)
+
+    def _publish(self, fraction: float, segments: Optional[int], eta: Optional[float], coalesce: bool = False):
+        self.bus.publish_event(self.job_id, {
+            "status": "progress",
+            "job_id": self.job_id,
+            "stage": self.stage,
+            "percent": round(fraction * 100, 1),
+            "eta_seconds": round(eta, 1) if eta is not None else None,
+            "segments": segments
+        }, coalesce=coalesce)
@@ -1,9 +1,30 @@
 import argparse
-import whisper
+import importlib
+import inspect
 import os
-import torch
+import sys
+import threading
+import types
 from datetime import timedelta
 
+# Whisper and torch are imported on first use so importing this module stays cheap
+
+# Loaded whisper models keyed by name, shared by all jobs in this process
+_models = {}
+
+# One lock per model name, held while that model loads or decodes; _models_lock only guards the dict
+_model_locks = {}
+_models_lock = threading.Lock()
+
+# Per-thread callback invoked after each decoded 30-second window
+_window_hooks = threading.local()
+_window_hook_installed = False
+_window_hook_unavailable = False
+_window_hook_lock = threading.Lock()
+
+# Seconds between cancellation checks while waiting for another job's decode of the same model
+DECODE_WAIT_INTERVAL = 5.0
+
 def format_timestamp(seconds):
     """Convert seconds to a formatted timestamp string (HH:MM:SS.mmm)"""
     td = timedelta(seconds=seconds)
@@ -12,45 +33,120 @@ def format_timestamp(seconds):
     milliseconds = int(td.microseconds / 1000)
     return f"{hours:02d}:{minutes:02d}:{seconds:02d}.{milliseconds:03d}"
 
-def transcribe(audio_path, model_name="large-v3", language="hi", beam_size=20):
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    
-    model = whisper.load_model(model_name, device=device)
-    
-    if language == "te":
-        result = model.transcribe(
-            audio_path,
-            language="te",
-            task="transcribe",
-            beam_size=20,  
-            best_of=1,  
-            temperature=0.0,
-            patience=1.0,  
-            fp16=True,
-            word_timestamps=True,
-            condition_on_previous_text=False,
-            compression_ratio_threshold=2.4,
-            logprob_threshold=-1.0,
-            verbose=True
-        )
-    else:
-        result = model.transcribe(
-            audio_path,
-            language="hi",
-            task="transcribe",
-            beam_size=20,
-            best_of=1,
-            temperature=0.0,
-            patience=1.0,
-            fp16=True,
-            word_timestamps=True,
-            condition_on_previous_text=False,
-            compression_ratio_threshold=2.4,
-            logprob_threshold=-1.0,
-            verbose=True
-        )
+def _model_lock(model_name):
+    with _models_lock:
+        return _model_locks.setdefault(model_name, threading.Lock())
+
+def load_model(model_name="large-v3"):
+    """Load a whisper model once per process and reuse it for later calls"""
+    model = _models.get(model_name)
+    if model is not None:
+        return model
+    # Loading can take minutes; only callers wanting this same model wait for it
+    with _model_lock(model_name):
+        if model_name not in _models:
+            import torch
+            import whisper
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+            _models[model_name] = whisper.load_model(model_name, device=device)
+        return _models[model_name]
+
+def _install_window_hook():
+    """Route whisper's per-window progress to the calling thread's callback; raising from it aborts the decode"""
+    global _window_hook_installed, _window_hook_unavailable
+    with _window_hook_lock:
+        if _window_hook_installed or _window_hook_unavailable:
+            return
+        try:
+            import tqdm
+            # whisper.transcribe is the re-exported function, so import the submodule by name
+            whisper_transcribe = importlib.import_module("whisper.transcribe")
+            try:
+                source = inspect.getsource(whisper_transcribe.transcribe)
+            except (OSError, TypeError):
+                source = ""
+            if getattr(whisper_transcribe, "tqdm", None) is not tqdm or "pbar.update(" not in source:
+                version = getattr(sys.modules.get("whisper"), "__version__", "unknown")
+                print(
+                    f"Warning: whisper {version} no longer reports progress through tqdm; "
+                    "per-window progress and cancellation are disabled"
+                )
+                _window_hook_unavailable = True
+                return
+            count_segments = "all_segments" in source
+
+            class WindowProgress(tqdm.tqdm):
+                def update(self, n=1):
+                    super().update(n)
+                    # A hidden bar does not advance self.n, so count frames ourselves
+                    self.frames_done = getattr(self, "frames_done", 0) + n
+                    callback = getattr(_window_hooks, "callback", None)
+                    if callback:
+                        segments = sys._getframe(1).f_locals.get("all_segments") if count_segments else None
+                        callback(self.frames_done, self.total, len(segments) if isinstance(segments, list) else None)
+
+            # Relies on whisper internals (verified against openai-whisper 20250625): transcribe()
+            # advances a tqdm.tqdm bar once per window, even when hidden, and keeps decoded segments
+            # in a local named all_segments. Both are checked against its source above; without the
+            # bar there is no hook (stage checkpoints only), without all_segments counts are None
+            whisper_transcribe.tqdm = types.SimpleNamespace(tqdm=WindowProgress)
+            _window_hook_installed = True
+        except Exception as e:
+            print(f"Warning: could not install whisper window hook: {e}")
+
+def transcribe(audio_path, model_name="large-v3", language="hi", beam_size=20, on_window=None, check_cancelled=None):
+    """Transcribe audio with whisper, reporting windows to on_window and polling check_cancelled before decoding"""
+    model = load_model(model_name)
+    _install_window_hook()
+    # Whisper installs kv-cache hooks on the model for every decode, so two decodes sharing
+    # one model would mix their caches; jobs using the same model take turns here
+    decode_lock = _model_lock(model_name)
+    # A job queued behind another decode can still be cancelled
+    while not decode_lock.acquire(timeout=DECODE_WAIT_INTERVAL):
+        if check_cancelled:
+            check_cancelled()
+    _window_hooks.callback = on_window
+    try:
+        # The job may have been cancelled while it waited; stop before a full decode
+        if check_cancelled:
+            check_cancelled()
+        if language == "te":
+            result = model.transcribe(
+                audio_path,
+                language="te",
+                task="transcribe",
+                beam_size=20,  
+                best_of=1,  
+                temperature=0.0,
+                patience=1.0,  
+                fp16=True,
+                word_timestamps=True,
+                condition_on_previous_text=False,
+                compression_ratio_threshold=2.4,
+                logprob_threshold=-1.0,
+                verbose=None
+            )
+        else:
+            result = model.transcribe(
+                audio_path,
+                language="hi",
+                task="transcribe",
+                beam_size=20,
+                best_of=1,
+                temperature=0.0,
+                patience=1.0,
+                fp16=True,
+                word_timestamps=True,
+                condition_on_previous_text=False,
+                compression_ratio_threshold=2.4,
+                logprob_threshold=-1.0,
+                verbose=None
+            )
     
-    return {
-        "text": result["text"].strip(),
-        "segments": result["segments"]
-    }
\ No newline at end of file
+        return {
+            "text": result["text"].strip(),
+            "segments": result["segments"]
+        }
+    finally:
+        _window_hooks.callback = None
+        decode_lock.release()
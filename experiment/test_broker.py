@@ -0,0 +1,217 @@
+import sqlite3
+import sys
+from contextlib import closing
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+import broker
+
+
+@pytest.fixture
+def test_broker(tmp_path):
+    return broker.create_broker(f"sqlite:///{tmp_path / 'broker.sqlite3'}")
+
+
+def age_job(test_broker, job_id, seconds):
+    """Pretend the job's lease was last renewed seconds ago"""
+    with closing(sqlite3.connect(test_broker.path)) as conn, conn:
+        conn.execute("UPDATE jobs SET updated = updated - ? WHERE job_id = ?", (seconds, job_id))
+
+
+def disconnect(test_broker, client_id, seconds):
+    """Pretend the client disconnected seconds ago"""
+    test_broker.unregister_session(client_id, "owner")
+    with closing(sqlite3.connect(test_broker.path)) as conn, conn:
+        conn.execute("UPDATE sessions SET last_seen = last_seen - ? WHERE client_id = ?", (seconds, client_id))
+
+
+def bodies(messages):
+    return [(message["client_id"], message["body"]) for message in messages]
+
+
+def test_submit_coalesces_into_queued_job(test_broker):
+    assert test_broker.submit_job("job-1", "song", "alice", {"job_id": "job-1"}) == ("job-1", False)
+    assert test_broker.submit_job("job-2", "song", "bob", {"job_id": "job-2"}) == ("job-1", True)
+    # A different song gets its own job
+    assert test_broker.submit_job("job-3", "other", "bob", {"job_id": "job-3"}) == ("job-3", False)
+
+
+def test_submit_coalesces_only_into_running_job_with_live_lease(test_broker):
+    test_broker.submit_job("job-1", "song", "alice", {})
+    assert test_broker.claim_job("worker")["job_id"] == "job-1"
+    assert test_broker.submit_job("job-2", "song", "bob", {}) == ("job-1", True)
+
+    # The worker stopped renewing its lease: the job may never finish, so do not join it
+    age_job(test_broker, "job-1", broker.JOB_LEASE_TTL + 1)
+    assert test_broker.submit_job("job-3", "song", "carol", {}) == ("job-3", False)
+
+
+@pytest.mark.parametrize("status", ["done", "failed", "cancelled"])
+def test_submit_does_not_coalesce_into_finished_job(test_broker, status):
+    test_broker.submit_job("job-1", "song", "alice", {})
+    test_broker.claim_job("worker")
+    test_broker.finish_job("job-1", "worker", status)
+    assert test_broker.submit_job("job-2", "song", "bob", {}) == ("job-2", False)
+
+
+def test_complete_job_publishes_result_to_every_subscriber(test_broker):
+    test_broker.register_session("alice", "owner")
+    test_broker.register_session("bob", "owner")
+    test_broker.submit_job("job-1", "song", "alice", {})
+    test_broker.submit_job("job-2", "song", "bob", {})
+    test_broker.claim_job("worker")
+
+    assert test_broker.complete_job("job-1", "worker", '{"text": "done"}')
+    assert test_broker.job_state("job-1") == ("done", "worker")
+    assert sorted(bodies(test_broker.fetch_messages("owner"))) == [
+        ("alice", '{"text": "done"}'),
+        ("bob", '{"text": "done"}'),
+    ]
+    # Joining after the result was sent starts a new job instead of waiting forever
+    assert test_broker.submit_job("job-3", "song", "carol", {}) == ("job-3", False)
+
+
+def test_complete_job_publishes_nothing_once_lease_is_lost(test_broker):
+    test_broker.register_session("alice", "owner")
+    test_broker.submit_job("job-1", "song", "alice", {})
+    test_broker.claim_job("worker")
+    age_job(test_broker, "job-1", broker.JOB_LEASE_TTL + 1)
+    test_broker.recover_stale_jobs()
+    test_broker.fetch_messages("owner")
+
+    assert not test_broker.complete_job("job-1", "worker", '{"text": "late"}')
+    assert test_broker.job_state("job-1") == ("queued", None)
+    assert test_broker.fetch_messages("owner") == []
+
+
+def test_recover_stale_jobs_requeues_then_fails(test_broker):
+    test_broker.register_session("alice", "owner")
+    test_broker.submit_job("job-1", "song", "alice", {})
+
+    for attempt in range(1, broker.MAX_JOB_ATTEMPTS + 1):
+        assert test_broker.claim_job(f"worker-{attempt}")["job_id"] == "job-1"
+        assert test_broker.recover_stale_jobs() == []
+        age_job(test_broker, "job-1", broker.JOB_LEASE_TTL + 1)
+        assert test_broker.recover_stale_jobs() == ["job-1"]
+        # The worker that lost the lease can no longer renew it
+        assert not test_broker.renew_job("job-1", f"worker-{attempt}")
+
+    assert test_broker.job_state("job-1")[0] == "failed"
+    assert bodies(test_broker.fetch_messages("owner")) == (
+        [("alice", "Processing was interrupted. Retrying...")] * (broker.MAX_JOB_ATTEMPTS - 1)
+        + [("alice", "Error during processing: the worker stopped responding")]
+    )
+    assert test_broker.claim_job("worker") is None
+
+
+def test_fetch_messages_keeps_messages_of_client_reconnecting_meanwhile(test_broker, monkeypatch):
+    test_broker.register_session("alice", "owner")
+    test_broker.register_session("bob", "other-owner")
+    test_broker.publish("bob", "json", "important")
+    test_broker.publish("alice", "text", "hello")
+
+    # Bob reconnects to this process between the read and the delete
+    transaction = test_broker._transaction
+
+    def reconnect_then_transaction():
+        test_broker.register_session("bob", "owner")
+        return transaction()
+
+    monkeypatch.setattr(test_broker, "_transaction", reconnect_then_transaction)
+    assert bodies(test_broker.fetch_messages("owner")) == [("alice", "hello")]
+    monkeypatch.undo()
+
+    assert bodies(test_broker.fetch_messages("owner")) == [("bob", "important")]
+    assert test_broker.fetch_messages("owner") == []
+
+
+def test_locked_database_error_is_not_masked(test_broker, monkeypatch):
+    monkeypatch.setattr(
+        test_broker, "_connect",
+        lambda: sqlite3.connect(test_broker.path, timeout=0.1, isolation_level=None)
+    )
+    with closing(sqlite3.connect(test_broker.path, isolation_level=None)) as holder:
+        holder.execute("BEGIN IMMEDIATE")
+        with pytest.raises(sqlite3.OperationalError, match="database is locked"):
+            test_broker.claim_job("worker")
+        holder.execute("ROLLBACK")
+
+
+def test_unsubscribe_cancels_only_when_last_subscriber_leaves(test_broker):
+    test_broker.submit_job("job-1", "song", "alice", {})
+    test_broker.submit_job("job-2", "song", "bob", {})
+
+    assert test_broker.unsubscribe("job-1", "alice") == "detached"
+    assert test_broker.job_state("job-1") == ("queued", None)
+    # Not subscribed (any more)
+    assert test_broker.unsubscribe("job-1", "alice") is None
+    assert test_broker.unsubscribe("job-1", "carol") is None
+    assert test_broker.unsubscribe("job-1", "bob") == "stopped"
+    assert test_broker.job_state("job-1") == ("cancelled", None)
+
+
+def test_unsubscribe_leaves_finished_job_alone(test_broker):
+    test_broker.submit_job("job-1", "song", "alice", {})
+    test_broker.claim_job("worker")
+    test_broker.complete_job("job-1", "worker", "{}")
+
+    assert test_broker.unsubscribe("job-1", "alice") == "finished"
+    assert test_broker.job_state("job-1") == ("done", "worker")
+    # Even after the sweep; a client that never subscribed learns nothing about the job
+    test_broker.cancel_abandoned_jobs()
+    assert test_broker.unsubscribe("job-1", "alice") == "finished"
+    assert test_broker.unsubscribe("job-1", "bob") is None
+
+
+def test_cancel_abandoned_jobs_waits_for_every_subscriber(test_broker):
+    test_broker.register_session("alice", "owner")
+    test_broker.register_session("bob", "owner")
+    test_broker.submit_job("job-1", "song", "alice", {})
+    test_broker.submit_job("job-2", "song", "bob", {})
+
+    disconnect(test_broker, "alice", broker.DISCONNECT_GRACE + 1)
+    assert test_broker.cancel_abandoned_jobs() == []
+
+    # Still within the grace period to reconnect
+    disconnect(test_broker, "bob", broker.DISCONNECT_GRACE - 10)
+    assert test_broker.cancel_abandoned_jobs() == []
+
+    disconnect(test_broker, "bob", broker.DISCONNECT_GRACE + 1)
+    assert test_broker.cancel_abandoned_jobs() == ["job-1"]
+    assert test_broker.job_state("job-1") == ("cancelled", None)
+    # Never claimed, so its files are handed back for cleanup
+    assert test_broker.purge_unclaimed_cancelled_jobs() == [{}]
+    assert test_broker.job_state("job-1") == (None, None)
+
+
+def test_purge_expired_jobs_keeps_jobs_in_flight(test_broker):
+    test_broker.submit_job("finished", "song-1", "alice", {})
+    test_broker.claim_job("worker")
+    test_broker.complete_job("finished", "worker", "{}")
+    test_broker.submit_job("running", "song-2", "alice", {})
+    test_broker.claim_job("worker")
+    test_broker.submit_job("queued", "song-3", "alice", {})
+    for job_id in ("finished", "running", "queued"):
+        age_job(test_broker, job_id, broker.JOB_TTL + 1)
+
+    assert test_broker.purge_expired_jobs() == 1
+    assert test_broker.job_state("finished") == (None, None)
+    assert test_broker.job_state("running") == ("running", "worker")
+    assert test_broker.job_state("queued") == ("queued", None)
+
+
+def test_purge_expired_sessions_drops_sessions_of_dead_owners(test_broker):
+    test_broker.register_session("alice", "dead-owner")
+    test_broker.register_session("bob", "owner")
+    with closing(sqlite3.connect(test_broker.path)) as conn, conn:
+        conn.execute(
+            "UPDATE sessions SET last_seen = last_seen - ? WHERE client_id = 'alice'",
+            (broker.SESSION_RETENTION + 1,)
+        )
+
+    assert test_broker.purge_expired_sessions() == 1
+    assert test_broker.session_owner("alice") is None
+    assert test_broker.session_owner("bob") == "owner"
@@ -0,0 +1,62 @@
+import json
+import sqlite3
+import sys
+import types
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+import broker
+import progress as progress_module
+from progress import ProgressBus, JobProgress
+
+
+class LockedBroker:
+    def publish_job(self, job_id, kind, body):
+        raise sqlite3.OperationalError("database is locked")
+
+
+def test_failed_window_progress_does_not_abort_the_job(monkeypatch):
+    monkeypatch.setattr(broker, "_broker", LockedBroker())
+    progress = JobProgress("job", bus=ProgressBus(min_interval=0))
+
+    # Coalesced window events are best effort
+    progress.update(0.5, 1)
+
+    # Stage boundaries must reach the client, so their failures still surface
+    with pytest.raises(sqlite3.OperationalError):
+        progress.start_stage("transcription")
+
+
+def test_window_events_are_coalesced_but_stage_events_always_sent(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(progress_module, "time", types.SimpleNamespace(monotonic=lambda: now[0]))
+    test_broker = broker.create_broker(f"sqlite:///{tmp_path / 'broker.sqlite3'}")
+    monkeypatch.setattr(broker, "_broker", test_broker)
+    test_broker.register_session("client", "owner")
+    test_broker.submit_job("job", "key", "client", {})
+
+    progress = JobProgress("job", bus=ProgressBus(min_interval=1.0))
+    progress.start_stage("transcription")
+    for fraction in (0.1, 0.2, 0.3):
+        now[0] += 0.2
+        progress.update(fraction)
+    # The interval has passed since the last event that went out
+    now[0] += 0.5
+    progress.update(0.4)
+    now[0] += 0.1
+    progress.update(0.5)
+    progress.update(1.0)
+    progress.finish_stage(3)
+    progress.start_stage("transliteration")
+
+    events = [json.loads(message["body"]) for message in test_broker.fetch_messages("owner")]
+    assert [(event["stage"], event["percent"]) for event in events] == [
+        ("transcription", 0.0),
+        ("transcription", 40.0),
+        ("transcription", 100.0),
+        ("transcription", 100.0),
+        ("transliteration", 0.0),
+    ]
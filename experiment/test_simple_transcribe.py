@@ -0,0 +1,178 @@
+import sys
+import textwrap
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+import simple_transcribe
+
+# Laid out like openai-whisper: the package re-exports transcribe, shadowing the submodule
+WHISPER_INIT = """
+from .transcribe import transcribe
+__version__ = "stub"
+"""
+
+WHISPER_TRANSCRIBE = """
+import tqdm
+
+def transcribe(windows=3, frames_per_window=3000):
+    all_segments = []
+    with tqdm.tqdm(total=windows * frames_per_window, unit="frames", disable=True) as pbar:
+        for window in range(windows):
+            all_segments.extend([{"id": window}])
+            pbar.update(frames_per_window)
+    return {"text": "", "segments": all_segments}
+"""
+
+# Minimal stand-in used only when tqdm is not installed
+TQDM_STUB = """
+class tqdm:
+    def __init__(self, total=None, unit=None, disable=False):
+        self.total = total
+        self.n = 0
+        self.disable = disable
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def update(self, n=1):
+        if self.disable:
+            return
+        self.n += n
+"""
+
+
+@pytest.fixture
+def stub_whisper(tmp_path, monkeypatch):
+    (tmp_path / "whisper").mkdir()
+    (tmp_path / "whisper" / "__init__.py").write_text(textwrap.dedent(WHISPER_INIT))
+    (tmp_path / "whisper" / "transcribe.py").write_text(textwrap.dedent(WHISPER_TRANSCRIBE))
+    try:
+        import tqdm  # noqa: F401
+    except ImportError:
+        (tmp_path / "tqdm").mkdir()
+        (tmp_path / "tqdm" / "__init__.py").write_text(textwrap.dedent(TQDM_STUB))
+    monkeypatch.syspath_prepend(str(tmp_path))
+    for name in [name for name in sys.modules if name.split(".")[0] in ("whisper", "tqdm")]:
+        monkeypatch.delitem(sys.modules, name)
+    monkeypatch.setattr(simple_transcribe, "_window_hook_installed", False)
+    monkeypatch.setattr(simple_transcribe, "_window_hook_unavailable", False)
+    yield
+    simple_transcribe._window_hooks.callback = None
+    for name in [name for name in sys.modules if name.split(".")[0] in ("whisper", "tqdm")]:
+        del sys.modules[name]
+
+
+def test_window_hook_reports_each_window(stub_whisper):
+    import whisper
+
+    simple_transcribe._install_window_hook()
+    assert simple_transcribe._window_hook_installed
+
+    calls = []
+    simple_transcribe._window_hooks.callback = lambda *args: calls.append(args)
+    whisper.transcribe()
+
+    assert calls == [(3000, 9000, 1), (6000, 9000, 2), (9000, 9000, 3)]
+
+
+def test_window_hook_callback_aborts_transcription(stub_whisper):
+    import whisper
+
+    simple_transcribe._install_window_hook()
+
+    def cancel(frames_done, total_frames, segments):
+        raise RuntimeError("cancelled")
+
+    simple_transcribe._window_hooks.callback = cancel
+    with pytest.raises(RuntimeError, match="cancelled"):
+        whisper.transcribe()
+
+
+def test_transcribe_publishes_window_progress(stub_whisper, tmp_path, monkeypatch):
+    import json
+    import whisper
+    import broker
+    from progress import ProgressBus, JobProgress
+
+    class StubModel:
+        def transcribe(self, audio_path, **options):
+            return whisper.transcribe()
+
+    test_broker = broker.create_broker(f"sqlite:///{tmp_path / 'broker.sqlite3'}")
+    monkeypatch.setattr(broker, "_broker", test_broker)
+    monkeypatch.setitem(simple_transcribe._models, "stub", StubModel())
+    test_broker.register_session("client", "owner")
+    test_broker.submit_job("job", "key", "client", {})
+
+    # Same wiring as process_audio's on_window, without coalescing so every window is kept
+    progress = JobProgress("job", bus=ProgressBus(min_interval=0))
+    progress.start_stage("transcription")
+    simple_transcribe.transcribe(
+        "vocals.wav", model_name="stub",
+        on_window=lambda frames_done, total_frames, segments: progress.update(frames_done / total_frames, segments)
+    )
+
+    events = [json.loads(message["body"]) for message in test_broker.fetch_messages("owner")]
+    assert [(event["stage"], event["percent"], event["segments"]) for event in events] == [
+        ("transcription", 0.0, None),
+        ("transcription", 33.3, 1),
+        ("transcription", 66.7, 2),
+        ("transcription", 100.0, 3),
+    ]
+    assert all(event["eta_seconds"] is not None for event in events[1:])
+
+
+def test_transcribe_checks_cancellation_before_decoding(stub_whisper, monkeypatch):
+    decoded = []
+
+    class StubModel:
+        def transcribe(self, audio_path, **options):
+            decoded.append(audio_path)
+
+    def cancelled():
+        raise RuntimeError("cancelled")
+
+    monkeypatch.setitem(simple_transcribe._models, "stub", StubModel())
+    with pytest.raises(RuntimeError, match="cancelled"):
+        simple_transcribe.transcribe("vocals.wav", model_name="stub", check_cancelled=cancelled)
+
+    assert decoded == []
+    # The decode lock is released for the next job
+    assert not simple_transcribe._model_lock("stub").locked()
+
+
+def test_transcribe_checks_cancellation_while_waiting_for_decode(stub_whisper, monkeypatch):
+    class StubModel:
+        def transcribe(self, audio_path, **options):
+            raise AssertionError("decoded while another job held the model")
+
+    checks = []
+    windows = []
+
+    def cancelled():
+        checks.append(True)
+        if len(checks) == 2:
+            raise RuntimeError("cancelled")
+
+    monkeypatch.setitem(simple_transcribe._models, "stub", StubModel())
+    monkeypatch.setattr(simple_transcribe, "DECODE_WAIT_INTERVAL", 0.01)
+    decode_lock = simple_transcribe._model_lock("stub")
+    decode_lock.acquire()
+    try:
+        with pytest.raises(RuntimeError, match="cancelled"):
+            simple_transcribe.transcribe(
+                "vocals.wav", model_name="stub",
+                on_window=lambda *args: windows.append(args), check_cancelled=cancelled
+            )
+    finally:
+        decode_lock.release()
+
+    assert len(checks) == 2
+    # Waiting is not progress: no window events are reported
+    assert windows == []
@@ -0,0 +1,114 @@
+import sys
+import threading
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+# warmup probes Azure through lyrics_transliterator, which needs requests
+pytest.importorskip("requests")
+
+import warmup
+
+
+@pytest.fixture
+def steps(monkeypatch):
+    """Replace the warm-up steps; each test registers its own per capability"""
+    monkeypatch.setattr(warmup, "_capabilities", {})
+    monkeypatch.setattr(warmup, "_settled", {})
+    steps = {}
+    monkeypatch.setattr(warmup, "WARMUP_STEPS", steps)
+    return steps
+
+
+def blocking_step(release):
+    def step():
+        release.wait(5)
+    return step
+
+
+def failing_step():
+    raise RuntimeError("probe failed")
+
+
+def settle(name):
+    assert warmup._settled[name].wait(5)
+
+
+def test_not_ready_while_loading(steps):
+    release = threading.Event()
+    steps["transcription"] = blocking_step(release)
+    steps["wer"] = lambda: None
+
+    warmup.start_warm_up(["transcription", "wer"])
+    settle("wer")
+    assert warmup.capability_status("transcription") == "pending"
+    assert not warmup.readiness()["ready"]
+
+    release.set()
+    settle("transcription")
+    assert warmup.readiness()["ready"]
+    assert warmup.readiness()["degraded"] == []
+
+
+def test_failed_required_capability_is_never_ready(steps, monkeypatch):
+    monkeypatch.setattr(warmup, "RETRY_BACKOFF", 0.0)
+    steps["transcription"] = failing_step
+
+    warmup.start_warm_up(["transcription"])
+    settle("transcription")
+    assert not warmup.readiness()["ready"]
+
+    # Required capabilities are not retried, whatever the backoff
+    steps["transcription"] = lambda: None
+    assert not warmup.ensure_capability("transcription", timeout=1)
+    assert not warmup.readiness()["ready"]
+
+
+def test_failed_optional_capability_is_degraded_but_ready(steps):
+    steps["transliteration"] = failing_step
+
+    assert not warmup.ensure_capability("transliteration", timeout=5)
+    state = warmup.readiness()
+    assert state["ready"]
+    assert state["degraded"] == ["transliteration"]
+    assert state["capabilities"]["transliteration"]["error"] == "probe failed"
+
+    # Within the backoff the failure is not probed again
+    steps["transliteration"] = lambda: None
+    assert not warmup.ensure_capability("transliteration", timeout=1)
+
+
+def test_optional_capability_is_retried_after_backoff(steps, monkeypatch):
+    steps["transliteration"] = failing_step
+    assert not warmup.ensure_capability("transliteration", timeout=5)
+
+    monkeypatch.setattr(warmup, "RETRY_BACKOFF", 0.0)
+    release = threading.Event()
+    steps["transliteration"] = blocking_step(release)
+    warmup.start_warm_up(["transliteration"])
+
+    # While the retry runs the process stays ready, with the capability still degraded
+    assert warmup.capability_status("transliteration") == "pending"
+    state = warmup.readiness()
+    assert state["ready"]
+    assert state["degraded"] == ["transliteration"]
+
+    release.set()
+    assert warmup.ensure_capability("transliteration", timeout=5)
+    state = warmup.readiness()
+    assert state["ready"]
+    assert state["degraded"] == []
+    assert "retrying" not in state["capabilities"]["transliteration"]
+
+
+def test_ensure_capability_times_out(steps):
+    release = threading.Event()
+    steps["wer"] = blocking_step(release)
+    try:
+        assert not warmup.ensure_capability("wer", timeout=0.05)
+        assert warmup.capability_status("wer") == "pending"
+    finally:
+        release.set()
+    settle("wer")
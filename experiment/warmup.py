@@ -0,0 +1,124 @@
+import threading
+import time
+from typing import Callable, Dict, Any, Iterable
+
+from lyrics_transliterator import validate_azure_openai_key
+
+# Whisper model preloaded for transcription; jobs asking for another model load it on demand
+DEFAULT_WHISPER_MODEL = "large-v3"
+
+# Capabilities the process is useless without; the others have a degraded fallback
+# (uploads proceed without transliteration, /calculate-wer reports an error)
+REQUIRED_CAPABILITIES = {"transcription"}
+
+# Seconds after a failed warm-up before an optional capability is probed again, so one
+# network blip at boot does not disable it until the next restart
+RETRY_BACKOFF = 60.0
+
+# Readiness of each capability warmed up in this process
+_capabilities: Dict[str, Dict[str, Any]] = {}
+_settled: Dict[str, threading.Event] = {}
+_lock = threading.Lock()
+
+
+def _warm_transcription():
+    import demucs.separate  # noqa: F401
+    from simple_transcribe import load_model
+    load_model(DEFAULT_WHISPER_MODEL)
+
+
+def _warm_transliteration():
+    if not validate_azure_openai_key():
+        raise RuntimeError("Azure OpenAI API is not available")
+
+
+def _warm_wer():
+    from ai_wer import get_model
+    get_model()
+
+
+WARMUP_STEPS: Dict[str, Callable[[], None]] = {
+    "transcription": _warm_transcription,
+    "transliteration": _warm_transliteration,
+    "wer": _warm_wer,
+}
+
+
+def _run(name: str, step: Callable[[], None]):
+    started = time.time()
+    try:
+        step()
+        state = {"status": "ready"}
+    except Exception as e:
+        print(f"Warm-up of {name} failed: {str(e)}")
+        state = {"status": "failed", "error": str(e), "failed_at": time.time()}
+    state["seconds"] = round(time.time() - started, 2)
+    with _lock:
+        _capabilities[name] = state
+    _settled[name].set()
+
+
+def _retry_due(name: str, state: Dict[str, Any]) -> bool:
+    return (
+        state["status"] == "failed"
+        and name not in REQUIRED_CAPABILITIES
+        and time.time() - state["failed_at"] >= RETRY_BACKOFF
+    )
+
+
+def start_warm_up(capabilities: Iterable[str]):
+    """
+    Import heavy dependencies and load models in background threads, one per capability.
+
+    Capabilities already warming up or ready are skipped; an optional one that failed is
+    warmed up again once RETRY_BACKOFF has passed since the failure.
+    """
+    for name in capabilities:
+        with _lock:
+            state = _capabilities.get(name)
+            if state is not None and not _retry_due(name, state):
+                continue
+            # A retry is marked so readiness keeps treating the capability as optional-and-down meanwhile
+            _capabilities[name] = {"status": "pending"} if state is None else {
+                "status": "pending", "retrying": True, "error": state["error"]
+            }
+            _settled[name] = threading.Event()
+        threading.Thread(target=_run, args=(name, WARMUP_STEPS[name]), daemon=True).start()
+
+
+def capability_status(name: str) -> str:
+    """pending, ready or failed; capabilities not warmed up here report disabled"""
+    with _lock:
+        return _capabilities.get(name, {"status": "disabled"})["status"]
+
+
+def ensure_capability(name: str, timeout: float = 30.0) -> bool:
+    """
+    Warm the capability up here if nobody has yet, or retry it if its backoff has passed,
+    wait for it to settle and return whether it is ready
+    """
+    start_warm_up([name])
+    with _lock:
+        settled = _settled[name]
+    settled.wait(timeout)
+    return capability_status(name) == "ready"
+
+
+def readiness() -> Dict[str, Any]:
+    with _lock:
+        capabilities = {name: dict(state) for name, state in _capabilities.items()}
+    for name, state in capabilities.items():
+        state["required"] = name in REQUIRED_CAPABILITIES
+    return {
+        # Not ready while anything is still loading, nor ever if a required capability failed
+        "ready": all(
+            state["status"] == "ready"
+            or (not state["required"] and (state["status"] == "failed" or state.get("retrying")))
+            for state in capabilities.values()
+        ),
+        "degraded": sorted(
+            name for name, state in capabilities.items()
+            if state["status"] == "failed" or state.get("retrying")
+        ),
+        "capabilities": capabilities
+    }
@@ -0,0 +1,77 @@
+import argparse
+import asyncio
+import threading
+import time
+from typing import Optional
+
+from broker import get_broker, make_owner_id, JOB_LEASE_TTL
+from pipeline import process_audio
+from warmup import start_warm_up
+
+# Seconds to wait before polling the queue again when it is empty
+POLL_INTERVAL = 1.0
+
+# Seconds between lease renewals of the running job, well within JOB_LEASE_TTL
+LEASE_RENEW_INTERVAL = JOB_LEASE_TTL / 4
+
+def _renew_lease(job_id: str, worker_id: str, done: threading.Event):
+    """Keep the job's lease alive while the pipeline blocks in Demucs or Whisper"""
+    broker = get_broker()
+    while not done.wait(LEASE_RENEW_INTERVAL):
+        try:
+            if not broker.renew_job(job_id, worker_id):
+                # The pipeline's cancellation token notices too and stops at its next checkpoint
+                print(f"Worker {worker_id} lost the lease on job {job_id}")
+                return
+        except Exception as e:
+            print(f"Worker {worker_id} failed to renew lease on job {job_id}: {e}")
+
+def run_worker(worker_id: Optional[str] = None, stop_event: Optional[threading.Event] = None):
+    """Claim queued jobs from the broker and process them one at a time until stopped"""
+    broker = get_broker()
+    worker_id = worker_id or make_owner_id()
+    print(f"Worker {worker_id} waiting for jobs")
+
+    while not (stop_event and stop_event.is_set()):
+        # A broker error (e.g. the database is locked) must not kill the worker thread:
+        # nothing restarts it, and queued jobs would wait forever
+        try:
+            job = broker.claim_job(worker_id)
+        except Exception as e:
+            print(f"Worker {worker_id} failed to claim a job: {e}")
+            time.sleep(POLL_INTERVAL)
+            continue
+        if job is None:
+            time.sleep(POLL_INTERVAL)
+            continue
+
+        status = "failed"
+        done = threading.Event()
+        threading.Thread(target=_renew_lease, args=(job["job_id"], worker_id, done), daemon=True).start()
+        try:
+            if asyncio.run(process_audio(worker_id=worker_id, **job["payload"])):
+                status = "done"
+        except Exception as e:
+            print(f"Worker {worker_id} failed job {job['job_id']}: {e}")
+        finally:
+            done.set()
+        try:
+            broker.finish_job(job["job_id"], worker_id, status)
+        except Exception as e:
+            # The job's lease then runs out and recover_stale_jobs takes it back
+            print(f"Worker {worker_id} failed to finish job {job['job_id']}: {e}")
+            time.sleep(POLL_INTERVAL)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Process queued transcription jobs")
+    parser.add_argument("--concurrency", type=int, default=1, help="Number of jobs to process in parallel")
+    args = parser.parse_args()
+
+    # Load the default whisper model and probe Azure before the first job arrives
+    start_warm_up(["transcription", "transliteration"])
+
+    threads = [threading.Thread(target=run_worker, daemon=True) for _ in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()